@@ -1,7 +1,13 @@
 import re
 import sys
 import os
+import json
+import hashlib
+import time
+import socket
+import tempfile
 import subprocess
+import urllib.request
 from datetime import datetime
 
 # --- Configuration ---
@@ -9,6 +15,71 @@ from datetime import datetime
 HTML_TARGET_DIR = "/Users/gckanter/Library/Mobile Documents/com~apple~CloudDocs/Documents/Automation/Git/gckanter.github.io"
 # Format for the date-published field (e.g., 2025-11-12T12:24)
 DATE_FORMAT = "%Y-%m-%dT%H:%M" 
+# Commands tried, in order, to start a long-running pandoc server (pandoc 3 subcommand, pandoc 2.18+ binary)
+PANDOC_SERVER_COMMANDS = [['pandoc', 'server'], ['pandoc-server']]
+# Seconds to wait for the pandoc server to accept connections before falling back to subprocesses
+PANDOC_SERVER_STARTUP_TIMEOUT = 5
+# Seconds the pandoc server may spend on one document (pandoc's own default is only 2)
+PANDOC_SERVER_REQUEST_TIMEOUT = 30
+# Records the state of each Markdown file after its last conversion, so unchanged files can be skipped
+CACHE_FILE = os.path.expanduser("~/.cache/export_md_to_html.json")
+
+# --- Compiled Patterns ---
+_ALIAS_INLINE_RE = re.compile(r'^\s*aliases:\s*\[\s*(.*?)\s*\]', re.IGNORECASE)
+_LIST_ITEM_RE = re.compile(r'^\s*-\s*(.+)$')
+# A '---' frontmatter delimiter line
+_FRONTMATTER_DELIM_RE = re.compile(r'^[ \t]*---[ \t]*\r?$', re.MULTILINE)
+# Whole body lines (with their newline) to drop when publishing: Obsidian `!createdate` calls,
+# `= this.file.name` title headers, and any line containing « or »
+_SKIP_RE = re.compile(r'^[ \t]*(?:>[ \t]*\[\!createdate\].*|#[ \t]*`=.*|.*[«»].*)\n?', re.MULTILINE)
+
+# Captures the key of a "key: value" frontmatter line
+_FRONTMATTER_KEY_RE = re.compile(r'^\s*([^:]+):')
+
+def apply_frontmatter_updates(frontmatter_lines, updates):
+    """
+    Applies a batch of (key, value, adjacent_key) updates to the frontmatter lines
+    in a single pass. Each key's value is updated in place if it exists. Otherwise
+    the new key is placed immediately after its adjacent_key (if provided and found),
+    or appended to the end.
+    """
+    # Map each lowered key to the position of its update in the batch
+    pending = {key.lower(): n for n, (key, _, _) in enumerate(updates)}
+    adjacent_keys = {adjacent_key.lower() for _, _, adjacent_key in updates if adjacent_key}
+    key_index = [-1] * len(updates)
+    adjacent_index = {}
+    
+    # 1. Classify every line once, recording the first occurrence of each key
+    for i, line in enumerate(frontmatter_lines):
+        match = _FRONTMATTER_KEY_RE.match(line)
+        if not match:
+            continue
+        line_key = match.group(1).lower()
+        n = pending.get(line_key)
+        if n is not None and key_index[n] == -1:
+            key_index[n] = i
+        if line_key in adjacent_keys:
+            adjacent_index.setdefault(line_key, i)
+    
+    # 2. Update existing keys, and collect insertions for missing ones
+    inserts_after = {}
+    appended = []
+    for n, (key, value, adjacent_key) in enumerate(updates):
+        new_line = f'{key}: {value}'
+        if key_index[n] != -1:
+            frontmatter_lines[key_index[n]] = new_line
+        elif adjacent_key and adjacent_key.lower() in adjacent_index:
+            inserts_after.setdefault(adjacent_index[adjacent_key.lower()], []).append(new_line)
+        else:
+            # If adjacent_key was not provided, or if the adjacent_key was not found, 
+            # append the new key/value pair to the end.
+            appended.append(new_line)
+    
+    # 3. Insert new lines after their adjacent keys, working backwards so the
+    # recorded indices stay valid
+    for i in sorted(inserts_after, reverse=True):
+        frontmatter_lines[i + 1:i + 1] = inserts_after[i]
+    frontmatter_lines.extend(appended)
 
 def update_frontmatter(key, value, frontmatter_lines, adjacent_key=None):
     """
@@ -16,71 +87,37 @@ def update_frontmatter(key, value, frontmatter_lines, adjacent_key=None):
     it is added. If adjacent_key is provided and found, the new key is placed 
     immediately after the adjacent_key, otherwise it is appended to the end.
     """
-    is_updated = False
-    
-    # 1. Try to find and update existing key
-    for i, line in enumerate(frontmatter_lines):
-        # Match lines that start with the key (case-insensitive)
-        if re.match(r'^\s*' + re.escape(key) + r':\s*', line, re.IGNORECASE):
-            # Update the line with the new value
-            frontmatter_lines[i] = f'{key}: {value}'
-            is_updated = True
-            break
-            
-    # 2. If key not found, add it
-    if not is_updated:
-        new_line = f'{key}: {value}'
-        
-        if adjacent_key:
-            adjacent_index = -1
-            # Find the index of the adjacent key
-            for i, line in enumerate(frontmatter_lines):
-                if re.match(r'^\s*' + re.escape(adjacent_key) + r':\s*', line, re.IGNORECASE):
-                    adjacent_index = i
-                    break
-            
-            if adjacent_index != -1:
-                # Insert the new line immediately after the adjacent key
-                frontmatter_lines.insert(adjacent_index + 1, new_line)
-                return # Insertion successful, exit function
-        
-        # If adjacent_key was not provided, or if the adjacent_key was not found, 
-        # append the new key/value pair to the end.
-        frontmatter_lines.append(new_line)        
+    apply_frontmatter_updates(frontmatter_lines, [(key, value, adjacent_key)])
 
 def extract_title_and_parse_file(md_filepath):
     """
     Reads the file, separates content, extracts the title, and updates frontmatter.
-    Returns: (page_title, frontmatter_lines_new, content_to_publish_lines) or (None, None, None) on error.
+    The body is kept as a single string rather than split into lines, with its
+    original line endings; line_ending is that of the closing '---' line, for
+    rebuilding the frontmatter consistently.
+    Returns: (page_title, frontmatter_lines_new, content_to_publish, body_text, line_ending) or (None, None, None, None, None) on error.
     """
     try:
-        with open(md_filepath, 'r', encoding='utf-8') as f:
+        # newline='' keeps CRLF line endings as-is, so they can be written back unchanged
+        with open(md_filepath, 'r', encoding='utf-8', newline='') as f:
             content = f.read()
     except IOError as e:
         print(f"Error reading file: {e}")
-        return None, None, None
+        return None, None, None, None, None
 
-    lines = content.splitlines()
+    # Find the first two '---' delimiter lines
+    delimiters = _FRONTMATTER_DELIM_RE.finditer(content)
+    frontmatter_start = next(delimiters, None)
+    frontmatter_end = next(delimiters, None)
 
-    # Find frontmatter indices
-    frontmatter_start_index = -1
-    frontmatter_end_index = -1
-    
-    for i, line in enumerate(lines):
-        if line.strip() == '---':
-            if frontmatter_start_index == -1:
-                frontmatter_start_index = i
-            elif frontmatter_end_index == -1 and frontmatter_start_index != -1:
-                frontmatter_end_index = i
-                break
-
-    if frontmatter_start_index == -1 or frontmatter_end_index == -1:
+    if frontmatter_start is None or frontmatter_end is None:
         print("Error: Could not find valid YAML frontmatter ('---' required at start and end).")
-        return None, None, None
+        return None, None, None, None, None
         
-    # Exclude the '---' lines themselves
-    frontmatter_lines = lines[frontmatter_start_index + 1: frontmatter_end_index]
-    body_lines_full = lines[frontmatter_end_index + 1:]
+    # Exclude the '---' lines themselves. Only the (short) frontmatter is split into lines.
+    frontmatter_lines = content[frontmatter_start.end() + 1:frontmatter_end.start()].splitlines()
+    body_text = content[frontmatter_end.end() + 1:]
+    line_ending = '\r\n' if frontmatter_end.group().endswith('\r') else '\n'
     
     
     # --- 1. Extract Title from 'aliases' field ---
@@ -89,7 +126,7 @@ def extract_title_and_parse_file(md_filepath):
     for i, line in enumerate(frontmatter_lines):
         if line.strip().lower().startswith('aliases:'):
             # Look for inline list (aliases: [Title 1, Title 2])
-            match = re.match(r'^\s*aliases:\s*\[\s*(.*?)\s*\]', line, re.IGNORECASE)
+            match = _ALIAS_INLINE_RE.match(line)
             if match:
                 first_alias = match.group(1).split(',')[0].strip()
                 page_title = first_alias.strip('"\'')
@@ -97,7 +134,7 @@ def extract_title_and_parse_file(md_filepath):
             
             # Look for multi-line list format starting on the next line (aliases:\n  - Title 1)
             for j in range(i + 1, len(frontmatter_lines)):
-                list_item_match = re.match(r'^\s*-\s*(.+)$', frontmatter_lines[j])
+                list_item_match = _LIST_ITEM_RE.match(frontmatter_lines[j])
                 if list_item_match:
                     page_title = list_item_match.group(1).strip().strip('"\'')
                     break
@@ -114,33 +151,20 @@ def extract_title_and_parse_file(md_filepath):
     
     now_string = datetime.now().strftime(DATE_FORMAT)
     
-    update_frontmatter('status', 'published', frontmatter_lines)
-    update_frontmatter('date-published', now_string, frontmatter_lines, 'date-created')
-    update_frontmatter('obsidianUIMode', 'preview', frontmatter_lines)
+    apply_frontmatter_updates(frontmatter_lines, [
+        ('status', 'published', None),
+        ('date-published', now_string, 'date-created'),
+        ('obsidianUIMode', 'preview', None),
+    ])
 
     # --- 3. Filter Body Content for Publishing ---
     
-    content_to_publish_lines = []
-    
-    for line in body_lines_full:
-        # Filter out lines containing « or » (Requirement 3)
-        if '«' in line or '»' in line:
-            continue
-        
-        # Also remove the Obsidian `!createdate` call lines
-        if re.match(r'^\s*>\s*\[\!createdate\]', line):
-            print("deleting" + line);
-            continue
-            
-        # Also remove the Obsidian title header line
-        if re.match(r'^\s*#\s*`=', line):
-            print("deleting" + line);
-            continue
-            
-        content_to_publish_lines.append(line)
+    # Filter out lines containing « or » (Requirement 3), and also remove the
+    # Obsidian `!createdate` call and title header lines, in a single pass
+    content_to_publish = _SKIP_RE.sub('', body_text)
 
 
-    return page_title, frontmatter_lines, content_to_publish_lines, body_lines_full
+    return page_title, frontmatter_lines, content_to_publish, body_text, line_ending
 
 def run_pandoc_conversion(md_content):
     """
@@ -165,26 +189,125 @@ def run_pandoc_conversion(md_content):
         print("Please install Pandoc (https://pandoc.org/install.html) to use this script.")
         sys.exit(1)
 
+class PandocServer:
+    """
+    Context manager running one `pandoc server` process for the lifetime of a batch
+    run, so each document costs an HTTP round trip instead of a pandoc startup.
+    If no server can be started (e.g. pandoc older than 2.18), or a request fails,
+    conversion falls back to one pandoc subprocess per document, with no startup
+    amortization. Documents are never combined into one pandoc input, since
+    reference links, footnotes and heading ids would leak between pages.
+    """
 
-def generate_html_content(page_title, md_lines, md_filepath):
-    """Generates the final HTML string using Pandoc."""
-    
-    # 1. Prepare Markdown content for Pandoc
-    md_content = '\n'.join(md_lines)
-    
-    # 2. Run Pandoc conversion
-    html_body_fragment = run_pandoc_conversion(md_content)
+    def __init__(self):
+        self.process = None
+        self.url = None
+
+    def __enter__(self):
+        for command in PANDOC_SERVER_COMMANDS:
+            port = self._free_port()
+            try:
+                process = subprocess.Popen(
+                    command + ['--port', str(port), '--timeout', str(PANDOC_SERVER_REQUEST_TIMEOUT)],
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL
+                )
+            except FileNotFoundError:
+                continue
+            if self._wait_until_listening(process, port):
+                self.process = process
+                self.url = f'http://127.0.0.1:{port}'
+                break
+            self._stop(process)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.process:
+            self._stop(self.process)
+            self.process = None
+        return False
+
+    @staticmethod
+    def _free_port():
+        """Asks the OS for an unused local port."""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    @staticmethod
+    def _wait_until_listening(process, port):
+        """Polls until the server accepts connections; False if it exits or times out."""
+        deadline = time.monotonic() + PANDOC_SERVER_STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                return False
+            try:
+                with socket.create_connection(('127.0.0.1', port), timeout=0.1):
+                    return True
+            except OSError:
+                time.sleep(0.05)
+        return False
+
+    @staticmethod
+    def _stop(process):
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
 
-    # 3. Custom Insertion: Add the extracted title as the first H1 element inside the body
+    def _post(self, path, payload):
+        request = urllib.request.Request(
+            self.url + path,
+            data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json', 'Accept': 'application/json'}
+        )
+        # Allow a little longer than the server's own per-request timeout
+        with urllib.request.urlopen(request, timeout=PANDOC_SERVER_REQUEST_TIMEOUT + 5) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def convert(self, md_content):
+        """
+        Converts one Markdown document to an HTML fragment. If the server fails,
+        it is not used again and this and later documents go through subprocesses.
+        """
+        if not self.url:
+            return run_pandoc_conversion(md_content)
+            
+        payload = {'text': md_content, 'from': 'markdown', 'to': 'html', 'wrap': 'none'}
+        try:
+            result = self._post('/', payload)
+            if not isinstance(result, dict) or 'output' not in result:
+                raise ValueError(result.get('error', result) if isinstance(result, dict) else result)
+            return result['output'].strip()
+        except (OSError, ValueError) as e:
+            print(f"Warning: Pandoc server failed ({e}). Falling back to running pandoc per file.")
+            self.url = None
+            return run_pandoc_conversion(md_content)
+
+    def convert_batch(self, md_contents):
+        """Converts several Markdown documents to HTML fragments, one request per document."""
+        return [self.convert(md_content) for md_content in md_contents]
+
+
+def html_filename_for(md_filepath):
+    """Returns the name of the HTML file generated for a Markdown file."""
+    return os.path.splitext(os.path.basename(md_filepath))[0] + ".html"
+
+def generate_html_content(page_title, html_body_fragment, md_filepath):
+    """Generates the final HTML string around the Pandoc HTML fragment."""
+
+    # 1. Custom Insertion: Add the extracted title as the first H1 element inside the body
     custom_h1 = f'<h1>{page_title}</h1>'
     
-    # The final HTML body content combines the custom H1 with the Pandoc output.
+    # 2. The final HTML body content combines the custom H1 with the Pandoc output.
     body_html = f"""
     {custom_h1}
     {html_body_fragment}
     """
 
-    html_filename = os.path.splitext(os.path.basename(md_filepath))[0] + ".html"
+    html_filename = html_filename_for(md_filepath)
     
     # Use Tailwind for basic aesthetics and responsiveness
     html_template = f"""<!DOCTYPE html>
@@ -231,57 +354,142 @@ def generate_html_content(page_title, md_lines, md_filepath):
     
     return html_template, html_filename
 
+def load_convert_cache():
+    """Loads the conversion cache, returning an empty cache if it is missing or unreadable."""
+    try:
+        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_convert_cache(cache):
+    """Writes the conversion cache atomically (temp file + rename)."""
+    try:
+        cache_dir = os.path.dirname(CACHE_FILE)
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, CACHE_FILE)
+    except IOError as e:
+        print(f"Warning: Could not write conversion cache: {e}")
+
+def _content_digest(filepath):
+    """Returns a short content hash of the file."""
+    with open(filepath, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+# Hash of this script, so edits to the HTML template or configuration invalidate cached conversions
+SCRIPT_VERSION = _content_digest(os.path.abspath(__file__))
+
+def make_cache_entry(md_filepath, output_path):
+    """Captures the current state of a converted Markdown file and its HTML output."""
+    return {
+        'mtime_ns': os.stat(md_filepath).st_mtime_ns,
+        'digest': _content_digest(md_filepath),
+        'output_path': output_path,
+        'script_version': SCRIPT_VERSION,
+    }
+
+def is_cache_hit(cache, md_filepath, output_path):
+    """
+    Checks whether the Markdown file is unchanged since it was last converted to
+    output_path by this version of the script, and that output still exists.
+    The mtime is compared first; the content is only hashed when it differs, and
+    on a content match the stored mtime is refreshed so later runs skip the hash.
+    """
+    entry = cache.get(md_filepath)
+    if (not entry
+            or entry.get('script_version') != SCRIPT_VERSION
+            or entry.get('output_path') != output_path
+            or not os.path.exists(output_path)):
+        return False
+    try:
+        mtime_ns = os.stat(md_filepath).st_mtime_ns
+        if mtime_ns == entry['mtime_ns']:
+            return True
+        if _content_digest(md_filepath) == entry['digest']:
+            entry['mtime_ns'] = mtime_ns
+            return True
+        return False
+    except IOError:
+        return False
+
 def main_process():
-    if len(sys.argv) < 2:
-        print("Usage: python publishing_automation.py <path_to_markdown_file>")
+    # --force republishes every file, ignoring the conversion cache
+    force = '--force' in sys.argv[1:]
+    md_filepaths = [arg for arg in sys.argv[1:] if arg != '--force']
+    
+    if not md_filepaths:
+        print("Usage: python publishing_automation.py [--force] <path_to_markdown_file> [<path_to_markdown_file> ...]")
         sys.exit(1)
 
-    md_filepath = sys.argv[1]
+    documents = []
+    cache = load_convert_cache()
     
-    # Ensure absolute path is used
-    if not os.path.isabs(md_filepath):
-        md_filepath = os.path.join(os.getcwd(), md_filepath)
+    for md_filepath in md_filepaths:
+        # Ensure absolute path is used
+        if not os.path.isabs(md_filepath):
+            md_filepath = os.path.join(os.getcwd(), md_filepath)
+            
+        # Skip files that haven't changed since they were last converted
+        if not force and is_cache_hit(cache, md_filepath, os.path.join(HTML_TARGET_DIR, html_filename_for(md_filepath))):
+            print(f"\n⏩ Cache hit, skipping unchanged file: {md_filepath}")
+            continue
+            
+        page_title, frontmatter_lines_new, content_to_publish, original_body_text, line_ending = extract_title_and_parse_file(md_filepath)
         
-    page_title, frontmatter_lines_new, content_to_publish_lines, original_content_lines = extract_title_and_parse_file(md_filepath)
-    
-    if not page_title:
-        sys.exit(1) # Exit if parsing failed
+        if not page_title:
+            sys.exit(1) # Exit if parsing failed
+            
+        documents.append((md_filepath, page_title, frontmatter_lines_new, content_to_publish, original_body_text, line_ending))
 
-    # --- Step 3: Write Updated Markdown File (Frontmatter changes only) ---
+    # --- Step 3: Write Updated Markdown Files (Frontmatter changes only) ---
     
-    # Reconstruct the Markdown file with updated frontmatter
-    updated_md_lines = (
-        ['---'] + 
-        frontmatter_lines_new + 
-        ['---'] + 
-        original_content_lines
-    )
-    
-    try:
-        with open(md_filepath, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(updated_md_lines))
-        print(f"\n✅ Successfully updated original Markdown file:")
-        print(f"  -> {md_filepath} (Status set to 'Published', date/UIMode updated)")
-    except IOError as e:
-        print(f"❌ Error updating original Markdown file: {e}")
-        sys.exit(1)
+    for md_filepath, _, frontmatter_lines_new, _, original_body_text, line_ending in documents:
+        # Reconstruct the Markdown file with updated frontmatter, reusing the body text
+        # as-is and the source's line ending for the header
+        updated_header = line_ending.join(['---'] + frontmatter_lines_new + ['---', ''])
+        
+        try:
+            with open(md_filepath, 'w', encoding='utf-8', newline='') as f:
+                f.write(updated_header + original_body_text)
+            print(f"\n✅ Successfully updated original Markdown file:")
+            print(f"  -> {md_filepath} (Status set to 'Published', date/UIMode updated)")
+        except IOError as e:
+            print(f"❌ Error updating original Markdown file: {e}")
+            sys.exit(1)
 
 
-    # --- Step 4: Generate and Write HTML File ---
+    # --- Step 4: Generate and Write HTML Files ---
     
-    html_template, html_filename = generate_html_content(page_title, content_to_publish_lines, md_filepath)
-    html_target_path = os.path.join(HTML_TARGET_DIR, html_filename)
+    # Convert every document through one Pandoc server (without one, Pandoc runs once per file)
+    if documents:
+        with PandocServer() as server:
+            html_body_fragments = server.convert_batch([content_to_publish for _, _, _, content_to_publish, _, _ in documents])
+    else:
+        html_body_fragments = []
+    
+    for (md_filepath, page_title, _, _, _, _), html_body_fragment in zip(documents, html_body_fragments):
+        html_template, html_filename = generate_html_content(page_title, html_body_fragment, md_filepath)
+        html_target_path = os.path.join(HTML_TARGET_DIR, html_filename)
 
-    try:
-        os.makedirs(HTML_TARGET_DIR, exist_ok=True)
-        with open(html_target_path, 'w', encoding='utf-8') as f:
-            f.write(html_template)
-        print(f"\n✅ Successfully generated HTML file:")
-        print(f"  -> Path: {html_target_path}")
-        print(f"  -> Page Title: '{page_title}'")
-    except IOError as e:
-        print(f"❌ Error writing HTML file to target directory: {e}. Check directory permissions.")
-        sys.exit(1)
+        try:
+            os.makedirs(HTML_TARGET_DIR, exist_ok=True)
+            with open(html_target_path, 'w', encoding='utf-8') as f:
+                f.write(html_template)
+            print(f"\n✅ Successfully generated HTML file:")
+            print(f"  -> Path: {html_target_path}")
+            print(f"  -> Page Title: '{page_title}'")
+        except IOError as e:
+            print(f"❌ Error writing HTML file to target directory: {e}. Check directory permissions.")
+            sys.exit(1)
+            
+        # Record the Markdown file as written in Step 3, so the next run can skip it
+        cache[md_filepath] = make_cache_entry(md_filepath, html_target_path)
+        
+    # Saved even if every file was a cache hit, to keep any refreshed mtimes
+    save_convert_cache(cache)
 
 # Ensure the main function is called only when the script is executed directly
 if __name__ == "__main__":
@@ -2,15 +2,27 @@ import os
 import glob
 import json
 import re
-from bs4 import BeautifulSoup
+from html import escape
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from lxml import html as lxml_html
+from lxml.cssselect import CSSSelector
 
 # --- Configuration ---
 CONFIG_FILE = 'class_map.json'
 SEARCH_ROOT = '..' # Parent directory
 OUTPUT_SUFFIX = '_modified'
 EXCLUDE_DIRS = ['__pycache__', '.git', 'node_modules', 'venv', '.venv'] # Common exclusions
+DEBUG_PRETTY = False # Re-indent the output HTML (slower; only useful when diffing output)
 # ---------------------
 
+# Site pages are UTF-8; without this, libxml2 assumes Latin-1 for byte input lacking a <meta charset>
+_HTML_PARSER = lxml_html.HTMLParser(encoding='utf-8')
+# The start of a full document: optional BOM and comments, then a doctype or <html>/<head>/<body> tag
+_DOCUMENT_START_RE = re.compile(rb'^(?:\xef\xbb\xbf)?\s*(?P<comments>(?:<!--.*?-->\s*)*)<(?P<tag>!doctype|html|head|body)[\s>]', re.IGNORECASE | re.DOTALL)
+# A selector that is only a tag name, e.g. 'h1'
+_TAG_SELECTOR_RE = re.compile(r'^[A-Za-z][\w-]*$')
+
 def load_class_map(config_path):
     """Loads the element-to-class mapping from the JSON configuration file."""
     try:
@@ -24,190 +36,180 @@ def load_class_map(config_path):
         print(f"Error: Invalid JSON format in '{config_path}'. Please check the syntax.")
         return None
 
-def parse_selector(selector):
+@lru_cache(maxsize=None)
+def _compile_selector(selector):
     """
-    Parses a CSS-like selector string and returns a dict with:
-    - tag: the HTML tag name (or None for universal)
-    - id: the element ID (or None)
-    - classes: list of class names (or empty list)
-    
-    Supports formats like:
-    - 'div' (just tag)
-    - '#my-id' (just ID)
-    - '.my-class' (just class)
-    - 'div#my-id' (tag + ID)
-    - 'div.my-class' (tag + class)
-    - 'div.class1.class2' (tag + multiple classes)
-    - 'div#my-id.my-class' (tag + ID + class)
+    Compiles a CSS selector to a matcher once per process, so it is reused across
+    files rather than re-translated for every page. Plain tag selectors use lxml's
+    tag-filtered iter(), which is about twice as fast as the equivalent XPath;
+    everything else goes through cssselect's XPath.
     """
-    result = {
-        'tag': None,
-        'id': None,
-        'classes': []
-    }
-    
-    # Extract ID (matches #identifier)
-    id_match = re.search(r'#([\w-]+)', selector)
-    if id_match:
-        result['id'] = id_match.group(1)
-        selector = selector.replace(id_match.group(0), '')
-    
-    # Extract classes (matches .classname)
-    class_matches = re.findall(r'\.([\w-]+)', selector)
-    if class_matches:
-        result['classes'] = class_matches
-        for match in class_matches:
-            selector = selector.replace(f'.{match}', '', 1)
-    
-    # What remains should be the tag name (if any)
     selector = selector.strip()
-    if selector and not selector.startswith('#') and not selector.startswith('.'):
-        result['tag'] = selector
-    
-    return result
+    if _TAG_SELECTOR_RE.match(selector):
+        tag = selector.lower()
+        return lambda tree: list(tree.iter(tag))
+    return CSSSelector(selector, translator='html')
 
-def element_matches_selector(element, selector_info):
+def apply_classes_to_html(html_content, class_map, log=print):
     """
-    Checks if a BeautifulSoup element matches the parsed selector criteria.
-    """
-    # Check tag name
-    if selector_info['tag'] and element.name != selector_info['tag']:
-        return False
-    
-    # Check ID
-    if selector_info['id']:
-        element_id = element.get('id')
-        if element_id != selector_info['id']:
-            return False
-    
-    # Check classes
-    if selector_info['classes']:
-        element_classes = element.get('class', [])
-        for required_class in selector_info['classes']:
-            if required_class not in element_classes:
-                return False
-    
-    return True
-
-def find_matching_elements(soup, selector):
-    """
-    Finds all elements in the soup that match the given selector.
-    Supports simple selectors and descendant selectors (space-separated).
-    
-    Examples:
-    - 'div' - all div elements
-    - 'div#carousel' - div with id="carousel"
-    - 'div.carousel-item' - div with class="carousel-item"
-    - 'div.class1.class2' - div with both classes
-    - 'div img' - img elements that are descendants of div elements
+    Parses HTML content (UTF-8 bytes) and applies classes based on the provided map.
+    Returns the modified HTML as UTF-8 bytes. Progress messages are passed to log
+    (print by default).
     """
-    # Check if this is a descendant selector (contains space)
-    if ' ' in selector.strip():
-        parts = selector.strip().split()
-        
-        # Start with all elements matching the first selector
-        parent_selector = parts[0]
-        parent_info = parse_selector(parent_selector)
-        
-        # Find all parent elements
-        parents = []
-        for element in soup.find_all():
-            if element_matches_selector(element, parent_info):
-                parents.append(element)
-        
-        # For each subsequent selector part, find descendants
-        current_elements = parents
-        for part in parts[1:]:
-            child_info = parse_selector(part)
-            next_elements = []
-            
-            for parent in current_elements:
-                for descendant in parent.find_all():
-                    if element_matches_selector(descendant, child_info) and descendant not in next_elements:
-                        next_elements.append(descendant)
-            
-            current_elements = next_elements
-        
-        return current_elements
+    # Decide from the source whether this is a full page or a fragment (such as
+    # navbar.html), so fragments aren't wrapped in an invented <html>/<div>
+    document_match = _DOCUMENT_START_RE.match(html_content)
+    leading_text = ''
+    if document_match:
+        roots = [lxml_html.document_fromstring(html_content, parser=_HTML_PARSER)]
     else:
-        # Simple selector (no descendants)
-        selector_info = parse_selector(selector)
-        matching_elements = []
-        
-        for element in soup.find_all():
-            if element_matches_selector(element, selector_info):
-                matching_elements.append(element)
-        
-        return matching_elements
-
-def apply_classes_to_html(html_content, class_map):
-    """Parses HTML content and applies classes based on the provided map."""
-    soup = BeautifulSoup(html_content, 'html.parser')
+        roots = lxml_html.fragments_fromstring(html_content, parser=_HTML_PARSER)
+        if roots and isinstance(roots[0], str):
+            leading_text = roots.pop(0)
     modified_count = 0
 
     # Iterate over the mapping: { 'selector': ['class-a', 'class-b', ...] }
     for selector, classes_to_add in class_map.items():
         if not classes_to_add:
             continue
-
-        # Find all elements matching the selector
-        matching_elements = find_matching_elements(soup, selector)
+        
+        # Drop duplicates from the configured classes once, rather than per element
+        classes_to_add = list(dict.fromkeys(classes_to_add))
+
+        # Find all elements matching the selector, including the root elements
+        # themselves (a tag-filtered iter() for plain tags, cssselect's XPath otherwise)
+        matcher = _compile_selector(selector)
+        # Top-level comments in fragments are kept for serialization but not matched
+        matching_elements = [element for root in roots if isinstance(root.tag, str) for element in matcher(root)]
         
         for element in matching_elements:
-            # 1. Get existing classes
-            existing_classes = element.get('class', [])
-            
-            # 2. Convert existing_classes list to a set for easy addition and deduplication
-            class_set = set(existing_classes)
-
-            # 3. Add the new classes, ignoring duplicates
-            for cls in classes_to_add:
-                class_set.add(cls)
-
-            # 4. Update the element's class attribute
-            element['class'] = sorted(list(class_set))  # Sort for consistency
+            # Append only the classes the element doesn't already have,
+            # keeping the existing order
+            existing_classes = (element.get('class') or '').split()
+            extra_classes = [cls for cls in classes_to_add if cls not in existing_classes]
+
+            # Update the element's class attribute only if something was added
+            if extra_classes:
+                element.set('class', ' '.join(existing_classes + extra_classes))
             modified_count += 1
         
         if matching_elements:
-            print(f"   ✓ '{selector}' matched {len(matching_elements)} element(s)")
+            log(f"   ✓ '{selector}' matched {len(matching_elements)} element(s)")
             
-    print(f" -> Applied classes to {modified_count} total element(s).")
-    # Return the nicely formatted HTML string
-    return soup.prettify()
+    log(f" -> Applied classes to {modified_count} total element(s).")
+    if document_match:
+        if document_match.group('tag').lower() == b'!doctype':
+            # Comments the source placed before the doctype stay before it
+            comments_before_doctype = document_match.group('comments').count(b'<!--')
+        else:
+            comments_before_doctype = None
+        return _serialize_document(roots[0], comments_before_doctype)
+    return escape(leading_text, quote=False).encode('utf-8') + b''.join(_serialize_node(node) for node in roots)
+
+def _serialize_node(node):
+    """Serializes a single element or comment (with its tail text) to UTF-8 bytes."""
+    return lxml_html.tostring(node, pretty_print=DEBUG_PRETTY, encoding='utf-8')
+
+def _serialize_document(root, comments_before_doctype):
+    """
+    Serializes a full page to UTF-8 bytes, including top-level comments around
+    <html>, in source order. The doctype is only written if the source had one
+    (comments_before_doctype is None otherwise), since libxml2 otherwise reports
+    (and would write) an HTML 4.0 Transitional default.
+    """
+    preceding = list(root.itersiblings(preceding=True))[::-1]
+    following = list(root.itersiblings())
+    parts = []
+    if comments_before_doctype is not None:
+        parts += [_serialize_node(node) for node in preceding[:comments_before_doctype]]
+        parts.append(root.getroottree().docinfo.doctype.encode('utf-8') + b'\n')
+        preceding = preceding[comments_before_doctype:]
+    parts += [_serialize_node(node) for node in preceding + [root] + following]
+    return b''.join(parts)
 
 def find_html_files(root_dir, exclude_dirs=None):
     """
-    Recursively finds all HTML files starting from root_dir,
+    Recursively yields all HTML files starting from root_dir,
     excluding the script's own directory and other specified directories.
     """
-    if exclude_dirs is None:
-        exclude_dirs = []
+    exclude_dirs = frozenset(exclude_dirs or [])
     
     # Get the absolute path of the script's directory to exclude it
     script_dir = os.path.abspath(os.path.dirname(__file__))
     
-    html_files = []
-    root_abs = os.path.abspath(root_dir)
-    
-    for dirpath, dirnames, filenames in os.walk(root_abs):
-        # Get absolute path of current directory
-        current_dir_abs = os.path.abspath(dirpath)
-        
-        # Skip the script's directory
-        if current_dir_abs == script_dir:
+    def walk(dirpath):
+        # Skip the script's directory (including when it is the search root)
+        if dirpath == script_dir:
             print(f" -> Skipping script directory: {dirpath}")
-            dirnames[:] = []  # Don't recurse into subdirectories
-            continue
+            return
         
-        # Skip excluded directories
-        dirnames[:] = [d for d in dirnames if d not in exclude_dirs]
+        subdirs = []
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        # Skip excluded directories
+                        if entry.name not in exclude_dirs:
+                            subdirs.append(entry.path)
+                    elif entry.name.endswith('.html') and OUTPUT_SUFFIX not in entry.name:
+                        yield entry.path
+        except OSError:
+            # Skip unreadable directories, as os.walk did
+            return
         
-        # Find HTML files in current directory
-        for filename in filenames:
-            if filename.endswith('.html') and OUTPUT_SUFFIX not in filename:
-                html_files.append(os.path.join(dirpath, filename))
+        for subdir in subdirs:
+            yield from walk(subdir)
     
-    return html_files
+    yield from walk(os.path.abspath(root_dir))
+
+def _has_same_content(filepath, data):
+    """Checks whether the file exists and holds exactly the given bytes (size is compared first)."""
+    try:
+        if os.path.getsize(filepath) != len(data):
+            return False
+        with open(filepath, 'rb') as f:
+            return f.read() == data
+    except OSError:
+        return False
+
+def _process_one(filepath, class_map):
+    """
+    Applies the class map to a single HTML file and writes the modified copy.
+    Returns: (filepath, output_filepath, log_lines); output_filepath is None if
+    the file was skipped or failed.
+    """
+    log_lines = [f"\nProcessing file: {filepath}"]
+    
+    # Skip the output files created in previous runs
+    if OUTPUT_SUFFIX in filepath:
+        log_lines.append(" -> Skipping previously modified output file.")
+        return filepath, None, log_lines
+        
+    try:
+        # Hand the raw bytes to lxml so the file is only decoded once, by the parser
+        with open(filepath, 'rb') as f:
+            content = f.read()
+            
+        modified_bytes = apply_classes_to_html(content, class_map, log=log_lines.append)
+        
+        # Determine the output filename
+        name, ext = os.path.splitext(filepath)
+        output_filepath = f"{name}{OUTPUT_SUFFIX}{ext}"
+        
+        # Leave the previous output untouched if nothing changed
+        if _has_same_content(output_filepath, modified_bytes):
+            log_lines.append(f" -> Unchanged, skipping write: {output_filepath}")
+            return filepath, output_filepath, log_lines
+        
+        with open(output_filepath, 'wb') as f:
+            f.write(modified_bytes)
+            
+        log_lines.append(f" -> Successfully saved modified file to: {output_filepath}")
+        return filepath, output_filepath, log_lines
+
+    except Exception as e:
+        log_lines.append(f" -> An error occurred while processing {filepath}: {e}")
+        return filepath, None, log_lines
 
 def process_files():
     """Main function to iterate through files and apply changes."""
@@ -221,8 +223,8 @@ def process_files():
     print(f"Excluding directories: {', '.join(EXCLUDE_DIRS)}")
     print(f"Excluding script directory: {os.path.abspath(os.path.dirname(__file__))}\n")
     
-    # Find all HTML files recursively
-    html_files = find_html_files(SEARCH_ROOT, EXCLUDE_DIRS)
+    # Find all HTML files recursively (collected, since they are counted and listed first)
+    html_files = list(find_html_files(SEARCH_ROOT, EXCLUDE_DIRS))
     
     if not html_files:
         print("No HTML files found matching the criteria. Aborting.")
@@ -233,31 +235,11 @@ def process_files():
         print(f"  - {f}")
     print()
 
-    for filepath in html_files:
-        print(f"\nProcessing file: {filepath}")
-        
-        # Skip the output files created in previous runs
-        if OUTPUT_SUFFIX in filepath:
-            print(" -> Skipping previously modified output file.")
-            continue
-            
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                content = f.read()
-                
-            modified_content = apply_classes_to_html(content, class_map)
-            
-            # Determine the output filename
-            name, ext = os.path.splitext(filepath)
-            output_filepath = f"{name}{OUTPUT_SUFFIX}{ext}"
-            
-            with open(output_filepath, 'w', encoding='utf-8') as f:
-                f.write(modified_content)
-                
-            print(f" -> Successfully saved modified file to: {output_filepath}")
-
-        except Exception as e:
-            print(f" -> An error occurred while processing {filepath}: {e}")
+    # Each file is independent, so spread the work across a process pool
+    # and print each file's log once it is done
+    with ProcessPoolExecutor() as executor:
+        for _, _, log_lines in executor.map(partial(_process_one, class_map=class_map), html_files, chunksize=4):
+            print('\n'.join(log_lines))
             
     print("\nProcessing complete.")
 